@@ -0,0 +1,187 @@
+"""Per-item path and link logic used by the publish task.
+
+This module has no I/O and is fully annotated so it can be compiled with mypyc
+(`mypyc _publish_core.py`), as the Docker image does. task.py imports it the
+same way whether or not it has been compiled.
+
+Python loads a compiled `_publish_core.*.so` in preference to this file, so after
+compiling locally, delete the `.so` (and the `build/` directory mypyc leaves) or
+rebuild it after every edit here, or the edits will silently have no effect.
+"""
+
+import zlib
+from datetime import datetime
+from functools import lru_cache
+from string import Formatter, Template
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Link relations replaced with ones pointing at the published item
+REPLACED_LINK_RELS = frozenset(("self", "canonical"))
+
+
+def parse_datetime(value: str) -> datetime:
+    """Parse a STAC datetime string.
+
+    Args:
+        value (str): A datetime string, normally RFC 3339.
+
+    Returns:
+        datetime: The parsed datetime.
+    """
+    try:
+        # much faster than dateutil for the RFC 3339 datetimes STAC requires
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        # dateutil is slow to import, so it's only loaded for other formats
+        from dateutil.parser import parse as dateparse  # type: ignore
+
+        return dateparse(value)
+
+
+@lru_cache(maxsize=32)
+def path_builder(template: str) -> Callable[[Dict[str, Any]], str]:
+    """Get a function that builds the path for an Item from a path template.
+
+    The template is parsed once here, so building each Item's path only has to
+    gather its field values and substitute them.
+
+    Args:
+        template (str): Path template using variables referencing Item fields.
+
+    Returns:
+        Callable[[Dict], str]: A function taking a STAC Item and returning its path.
+    """
+    _template = template.replace(":", "__colon__")
+    keys: List[str] = [
+        i[1] for i in Formatter().parse(_template.rstrip("/")) if i[1] is not None
+    ]
+    compiled = Template(_template)
+
+    def build(item: Dict[str, Any]) -> str:
+        subs: Dict[str, Any] = {}
+        dt: Optional[datetime] = None
+        for key in keys:
+            # collection
+            if key == "collection":
+                subs[key] = item["collection"]
+            # ID
+            elif key == "id":
+                subs[key] = item["id"]
+            # derived from date
+            elif key in ["year", "month", "day"]:
+                if dt is None:
+                    dt = parse_datetime(item["properties"]["datetime"])
+                vals = {"year": dt.year, "month": dt.month, "day": dt.day}
+                subs[key] = vals[key]
+            # Item property
+            else:
+                subs[key] = item["properties"][key.replace("__colon__", ":")]
+        return compiled.substitute(**subs).replace("__colon__", ":")
+
+    return build
+
+
+def shard_url(url: str, item_id: str, shard_count: int) -> str:
+    """Insert a shard prefix between the bucket and key of an S3 url.
+
+    S3 limits request rates per key prefix, so spreading items over several
+    prefixes raises the write throughput available to a batch.
+
+    Args:
+        url (str): An s3:// url.
+        item_id (str): ID of the Item, used to pick its shard.
+        shard_count (int): Number of shard prefixes to spread Items across.
+
+    Returns:
+        str: The url with a 'shardNN/' prefix added to its key.
+    """
+    bucket, _, key = url[5:].partition("/")
+    # crc32 rather than hash() so an Item maps to the same shard in every run
+    shard = zlib.crc32(item_id.encode()) % shard_count
+    return f"s3://{bucket}/shard{shard:02d}/{key}"
+
+
+def item_url(path: str, item_id: str, bucket: str, shard_count: int = 0) -> str:
+    """Get the s3:// url of an Item from its templated path.
+
+    Args:
+        path (str): The Item's path, from path_builder. Paths that aren't s3://
+            urls are placed in the given bucket.
+        item_id (str): ID of the Item.
+        bucket (str): Name of the S3 bucket for paths without one.
+        shard_count (int, optional): Number of shard prefixes to spread Items
+            across, or 0 to not shard. Defaults to 0.
+
+    Returns:
+        str: The s3:// url of the Item's JSON file.
+    """
+    # S3 keys always use '/', whatever the local path separator is
+    url = f"{path.rstrip('/')}/{item_id}.json"
+
+    if url[0:5] != "s3://":
+        url = f"s3://{bucket}/{url.lstrip('/')}"
+    if shard_count:
+        url = shard_url(url, item_id, shard_count)
+    return url
+
+
+def replace_links(links: List[Dict[str, Any]], url: str) -> List[Dict[str, Any]]:
+    """Get an Item's links with self and canonical links pointing at a url.
+
+    Args:
+        links (List[Dict]): The Item's current links.
+        url (str): The url the Item is published to.
+
+    Returns:
+        List[Dict]: The self and canonical links, followed by the other links.
+    """
+    return [
+        {"rel": "self", "href": url, "type": "application/json"},
+        {"rel": "canonical", "href": url, "type": "application/json"},
+        *(link for link in links if link["rel"] not in REPLACED_LINK_RELS),
+    ]
+
+
+def s3_location(url: str) -> Tuple[str, str]:
+    """Split an item url made by update_links into its S3 bucket and key.
+
+    Args:
+        url (str): An s3:// url, or the https url of an object in a public bucket.
+
+    Returns:
+        Tuple[str, str]: The bucket and key.
+    """
+    if url.startswith("https://"):
+        # https://<bucket>.s3.<region>.amazonaws.com/<key>
+        host, _, key = url[8:].partition("/")
+        return host.rsplit(".s3.", 1)[0], key
+    bucket, _, key = url[5:].partition("/")
+    return bucket, key
+
+
+def directory_prefix(key: str, item_id: str) -> str:
+    """Get the directory an Item's key is in, up to the path component holding its
+    id, for listing the Items already published alongside it.
+
+    Whole path components are compared, so an id that is also part of the
+    collection or shard name still gives the full directory:
+
+    >>> directory_prefix("naip/a/a.json", "a")
+    'naip/'
+    >>> directory_prefix("shard01/data/naip/01/01.json", "01")
+    'shard01/data/naip/'
+    >>> directory_prefix("naip/2020/a.json", "a")
+    'naip/2020/'
+
+    Args:
+        key (str): Key the Item is published to.
+        item_id (str): ID of the Item.
+
+    Returns:
+        str: The key prefix, ending in '/', or '' for a key at the bucket root.
+    """
+    parts = key.split("/")
+    end = len(parts) - 1
+    if item_id in parts[:end]:
+        end = parts.index(item_id)
+    return "".join(f"{part}/" for part in parts[:end])
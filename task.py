@@ -1,14 +1,27 @@
 #!/usr/bin/env python
 import boto3
 import logging
+import orjson
 import os
+from _publish_core import (
+    directory_prefix,
+    item_url,
+    path_builder,
+    replace_links,
+    s3_location,
+)
+from boto3.s3.transfer import TransferConfig
 from boto3utils import s3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from dateutil.parser import parse as dateparse
+from functools import partial
+from io import BytesIO
+from itertools import islice
 from stactask import Task
 from stac_validator import stac_validator
-from string import Formatter, Template
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 
 # Environment variables from the container
@@ -18,6 +31,18 @@ AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_SESSION_TOKEN = os.getenv("AWS_SESSION_TOKEN")
 AWS_DEFAULT_REGION = os.getenv("AWS_DEFAULT_REGION")
 
+# Default number of items published to S3 concurrently
+MAX_WORKERS = 32
+# Size of the S3 client's connection pool, the upper bound on useful concurrency
+MAX_POOL_CONNECTIONS = 64
+# S3 object metadata key holding an item's 'created' date, so it can be recovered
+# with a HEAD request instead of downloading the previously published item
+CREATED_METADATA_KEY = "stac-created"
+# Items larger than this are uploaded as multipart chunks of this size
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+# Error codes S3 returns for a missing object
+NOT_FOUND_CODES = ("404", "NoSuchKey", "NotFound")
+
 session = boto3.Session(
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
@@ -25,7 +50,36 @@ session = boto3.Session(
     region_name=AWS_DEFAULT_REGION,
 )
 
-s3session = s3(session, requester_pays=False)
+# adaptive retries back off when S3 throttles with SlowDown, and keepalive lets
+# the pooled connections be reused across requests
+s3client = session.client(
+    "s3",
+    config=Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        retries={"mode": "adaptive", "max_attempts": 10},
+        tcp_keepalive=True,
+        connect_timeout=3,
+        read_timeout=30,
+    ),
+)
+
+
+def head_or_none(bucket: str, key: str) -> Optional[Dict]:
+    """Get the metadata of an S3 object, if it exists.
+
+    Args:
+        bucket (str): Name of the S3 bucket.
+        key (str): Key of the object.
+
+    Returns:
+        Optional[Dict]: The HeadObject response, or None if there is no such object.
+    """
+    try:
+        return s3client.head_object(Bucket=bucket, Key=key)
+    except ClientError as err:
+        if err.response["Error"]["Code"] not in NOT_FOUND_CODES:
+            raise
+        return None
 
 
 class Publish(Task):
@@ -43,29 +97,15 @@ class Publish(Task):
         Returns:
             [str]: A path name
         """
-        _template = template.replace(":", "__colon__")
-        subs = {}
-        for key in [
-            i[1] for i in Formatter().parse(_template.rstrip("/")) if i[1] is not None
-        ]:
-            # collection
-            if key == "collection":
-                subs[key] = item["collection"]
-            # ID
-            elif key == "id":
-                subs[key] = item["id"]
-            # derived from date
-            elif key in ["year", "month", "day"]:
-                dt = dateparse(item["properties"]["datetime"])
-                vals = {"year": dt.year, "month": dt.month, "day": dt.day}
-                subs[key] = vals[key]
-            # Item property
-            else:
-                subs[key] = item["properties"][key.replace("__colon__", ":")]
-        return Template(_template).substitute(**subs).replace("__colon__", ":")
+        return path_builder(template)(item)
 
     def update_links(
-        self, item: Dict, template: str, bucket: str, public: bool
+        self,
+        item: Dict,
+        template: str,
+        bucket: str,
+        public: bool,
+        shard_count: int = 0,
     ) -> Tuple[Dict, str]:
         """Updates the links of an item to include self and canonical links.
 
@@ -74,45 +114,55 @@ class Publish(Task):
             template (str, optional): Path template using variables referencing Item fields. Defaults to'${collection}/${id}'.
             bucket (str): Name of S3 bucket which will be used in the href for the links.
             public (bool): Boolean value specifying if the S3 bucket is public or private.
+            shard_count (int, optional): Number of shard prefixes to spread Items
+                across, or 0 to not shard. Defaults to 0.
         Returns:
             Tuple[Dict, str]: A tuple consisting of an updated STAC item and its S3 url.
         """
-        url = os.path.join(self.get_path(item, template), f"{item['id']}.json")
-
-        if url[0:5] != "s3://":
-            url = f"s3://{bucket}/{url.lstrip('/')}"
+        url = item_url(self.get_path(item, template), item["id"], bucket, shard_count)
         if public:
             url = s3.s3_to_https(url)
 
         # add canonical and self links (and remove existing self link if present)
-        item["links"] = [
-            link for link in item["links"] if link["rel"] not in ["self", "canonical"]
-        ]
-        item["links"].insert(
-            0, {"rel": "canonical", "href": url, "type": "application/json"}
-        )
-        item["links"].insert(
-            0, {"rel": "self", "href": url, "type": "application/json"}
-        )
+        item["links"] = replace_links(item["links"], url)
 
         return item, url
 
-    def update_item_dates(self, item: Dict, url: str) -> Dict:
+    def update_item_dates(
+        self,
+        item: Dict,
+        bucket: str,
+        key: str,
+        force_new: bool = False,
+        existing: Optional[Set[Tuple[str, str]]] = None,
+    ) -> Dict:
         """Populates an item's 'created' and 'updated' properties by checking to see
         if the item already exists on S3.
 
         Args:
             item (Dict): A STAC Item.
-            url (str): Path to the item on S3 after templating its properties into
-                       the path_template parameter
+            bucket (str): S3 bucket the item is published to.
+            key (str): Key the item is published to, after templating its properties
+                       into the path_template parameter
+            force_new (bool, optional): Treat the item as new without checking S3,
+                       setting both dates to now. Defaults to False.
+            existing (Set[Tuple[str, str]], optional): (bucket, key) pairs of the
+                       objects known to exist, from list_existing. Items missing from
+                       it are treated as new without checking S3. Defaults to None.
         Returns:
-            Tuple[Dict, str]: A tuple consisting of an updated STAC item and its S3 url.
+            Dict: The updated STAC Item.
         """
         now = datetime.now(timezone.utc).isoformat()
         created = None
-        if s3session.exists(url):
-            old_item = s3session.read_json(url)
-            created = old_item["properties"].get("created", None)
+        if not force_new and (existing is None or (bucket, key) in existing):
+            head = head_or_none(bucket, key)
+            if head is not None:
+                created = head["Metadata"].get(CREATED_METADATA_KEY)
+                if created is None:
+                    # published before 'created' was stored in the object metadata
+                    old = s3client.get_object(Bucket=bucket, Key=key)
+                    old_item = orjson.loads(old["Body"].read())
+                    created = old_item["properties"].get("created", None)
         if created is None:
             created = now
         item["properties"]["created"] = created
@@ -120,23 +170,153 @@ class Publish(Task):
 
         return item
 
-    def publish_item_to_s3(self, item: Dict, url: str, headers: str, public: bool):
-        """Publishes an item to S3 at a specified url.
+    def list_existing(
+        self, items: List[Dict], locations: List[Tuple[str, str]]
+    ) -> Set[Tuple[str, str]]:
+        """Lists the objects already on S3 in the directories the items will be
+        published to, so existence checks need one request per 1000 objects in a
+        directory rather than one per item.
 
         Args:
-            item (Dict): A STAC Item.
-            url (str): Path to the item on S3 after templating its properties into
-                       the path_template parameter
-            headers (str): Headers to include in the request to upload to S3
+            items (List[Dict]): STAC Items, in the same order as their locations.
+            locations (List[Tuple[str, str]]): (bucket, key) pairs the items will be
+                       published to.
+        Returns:
+            Set[Tuple[str, str]]: (bucket, key) pairs of the existing objects.
+        """
+        # list each directory separately, up to the path component holding the
+        # item id: a prefix shared by the whole batch falls to 'shard' once
+        # items are sharded, or to '' once it spans collections, and listing
+        # that would page through the whole sharded keyspace or bucket
+        prefixes: Set[Tuple[str, str]] = set()
+        for item, (bucket, key) in zip(items, locations):
+            prefixes.add((bucket, directory_prefix(key, item["id"])))
+
+        existing: Set[Tuple[str, str]] = set()
+        paginator = s3client.get_paginator("list_objects_v2")
+        for bucket, prefix in prefixes:
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                existing.update(
+                    (bucket, obj["Key"]) for obj in page.get("Contents", [])
+                )
+
+        return existing
+
+    def upload_args(self, headers: Dict, public: bool) -> Dict:
+        """Builds the arguments shared by every item upload in a batch.
+
+        Args:
+            headers (Dict): Headers to include in the request to upload to S3
             public (bool): Boolean value specifying if the S3 bucket is public or private.
+        Returns:
+            Dict: Extra arguments for the S3 upload requests.
+        """
+        extra_args = {"ContentType": "application/json", **headers}
+        if public:
+            extra_args["ACL"] = "public-read"
+        return extra_args
+
+    def transfer_config(self, concurrency: int) -> TransferConfig:
+        """Builds the multipart upload config for a batch's large items.
+
+        Args:
+            concurrency (int): Number of items published at the same time.
+        Returns:
+            TransferConfig: Config for uploading items over MULTIPART_THRESHOLD.
+        """
+        # each publishing thread can be uploading a large item at once, and they
+        # all share the client's connection pool, so split the pool between them
+        # rather than letting a few large items take connections the rest need
+        return TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_THRESHOLD,
+            max_concurrency=max(1, MAX_POOL_CONNECTIONS // concurrency),
+        )
+
+    def publish_item_to_s3(
+        self,
+        item: Dict,
+        bucket: str,
+        key: str,
+        extra_args: Dict,
+        transfer_config: TransferConfig,
+    ):
+        """Publishes an item to S3 at a specified location.
+
+        Args:
+            item (Dict): A STAC Item.
+            bucket (str): S3 bucket to publish the item to.
+            key (str): Key to publish the item to, after templating its properties
+                       into the path_template parameter
+            extra_args (Dict): Extra arguments for the upload request, from
+                       upload_args. Not modified.
+            transfer_config (TransferConfig): Config for multipart uploads of large
+                       items, from transfer_config.
         Returns:
             None
         """
-        extra = {"ContentType": "application/json"}
-        extra.update(headers)
-        s3session.upload_json(item, url, public=public, extra=extra)
+        extra = {
+            **extra_args,
+            "Metadata": {
+                **extra_args.get("Metadata", {}),
+                CREATED_METADATA_KEY: item["properties"]["created"],
+            },
+        }
+        body = orjson.dumps(item)
+        if len(body) > MULTIPART_THRESHOLD:
+            s3client.upload_fileobj(
+                BytesIO(body), bucket, key, ExtraArgs=extra, Config=transfer_config
+            )
+        else:
+            s3client.put_object(Body=body, Bucket=bucket, Key=key, **extra)
         logging.info("Published to s3")
 
+    def publish_item(
+        self,
+        item: Dict,
+        location: Tuple[str, str],
+        extra_args: Dict,
+        transfer_config: TransferConfig,
+        stac_validate: bool,
+        force_new: bool,
+        existing: Optional[Set[Tuple[str, str]]],
+    ) -> Dict:
+        """Validates an item with updated links, updates its dates, and publishes
+        it to S3.
+
+        Args:
+            item (Dict): A STAC Item, with links already updated by update_links.
+            location (Tuple[str, str]): S3 bucket and key to publish the item to.
+            extra_args (Dict): Extra arguments for the upload request, from
+                       upload_args.
+            transfer_config (TransferConfig): Config for multipart uploads of large
+                       items, from transfer_config.
+            stac_validate (bool): Whether to validate the item before publishing it.
+            force_new (bool): Skip checking S3 for a previously published version.
+            existing (Set[Tuple[str, str]], optional): (bucket, key) pairs of the
+                       objects known to exist, or None to check every item.
+        Returns:
+            Dict: The updated STAC Item.
+        """
+        # validate before any S3 request so an invalid item fails without network
+        # round-trips; the dates added afterwards are always valid datetimes
+        if stac_validate:
+            # StacValidate keeps state from each run (e.g. the last schema checked
+            # in 'custom'), so it can't be reused; fetched schemas are cached at
+            # module level by stac_validator, so a new instance is cheap
+            stac = stac_validator.StacValidate()
+            if not stac.validate_dict(item):
+                raise Exception(
+                    f"STAC Item validation failed. Error: {stac.message[0]['error_message']}."
+                )
+
+        bucket, key = location
+        mod_item = self.update_item_dates(item, bucket, key, force_new, existing)
+
+        self.publish_item_to_s3(mod_item, bucket, key, extra_args, transfer_config)
+
+        return mod_item
+
     def process(self, public: bool, stac_validate: bool) -> List[Dict[str, Any]]:
         # process method overrides Task
         payload = self._payload
@@ -157,31 +337,65 @@ class Publish(Task):
         config = process.get("tasks", {}).get("publish", {})
         public = config.get("public", False)
         stac_validate = config.get("stac_validate", True)
+        force_new = config.get("force_new", False)
+        shard_count = int(config.get("shard_prefix_count", 0))
+        if shard_count < 0:
+            raise ValueError(
+                f"publish: shard_prefix_count must be 0 or more, not {shard_count}"
+            )
+        list_existing = config.get("list_existing", False)
+        # checked here, before any S3 requests, so a bad value can't fail the
+        # task after some items were already published
+        concurrency = max(
+            1, min(int(config.get("concurrency", MAX_WORKERS)), MAX_POOL_CONNECTIONS)
+        )
 
         items = self.items_as_dicts
 
         try:
             logging.debug("Publishing items to S3")
 
-            mod_items = []
-
-            stac = stac_validator.StacValidate()
-
+            # split each url into its bucket and key once, for every S3 request
+            locations = []
             for item in items:
-                link_item, url = self.update_links(
-                    item, path_template, DATA_BUCKET, public
+                _, url = self.update_links(
+                    item, path_template, DATA_BUCKET, public, shard_count
                 )
-
-                mod_item = self.update_item_dates(link_item, url)
-
-                mod_items.append(mod_item)
-                if stac_validate and not stac.validate_dict(mod_item):
-                    raise Exception(
-                        f"STAC Item validation failed. Error: {stac.message[0]['error_message']}."
-                    )
-                self.publish_item_to_s3(mod_item, url, headers, public)
-
-            return mod_items
+                locations.append(s3_location(url))
+
+            existing = (
+                self.list_existing(items, locations)
+                if list_existing and not force_new
+                else None
+            )
+
+            publish = partial(
+                self.publish_item,
+                extra_args=self.upload_args(headers, public),
+                transfer_config=self.transfer_config(concurrency),
+                stac_validate=stac_validate,
+                force_new=force_new,
+                existing=existing,
+            )
+
+            # validating the first item on this thread fills stac_validator's
+            # module-level schema cache, so the worker threads don't all miss it
+            # and fetch the same schemas at once
+            start = 0
+            if stac_validate and items:
+                publish(items[0], locations[0])
+                start = 1
+
+            # each item costs several S3 round-trips, so publish them concurrently.
+            # Items are updated in place, so the results aren't collected into a
+            # second list; iterating them just surfaces the first failure.
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for _ in executor.map(
+                    publish, islice(items, start, None), islice(locations, start, None)
+                ):
+                    pass
+
+            return items
 
         except Exception as err:
             msg = f"publish: failed publishing output items ({err})"